@@ -36,7 +36,7 @@ setup(
     install_requires=[
         'tqdm', 'astropy',
         'setuptools>=41.0.0', 'more-itertools',
-        'matplotlib', 'numpy', 'scipy==1.4.1',
+        'matplotlib', 'numpy', 'numba', 'scipy==1.4.1',
         'lightkurve>=1.9.0', 'calcos', 'costools'],
     classifiers=[
         'Development Status :: 3 - Alpha',
@@ -1,15 +1,16 @@
 import os, sys
+import operator
+from functools import reduce
 import numpy as np
+from numba import njit
 from astropy import units
 from astropy.io import fits
 from astropy import constants
 from lmfit.models import Model
 import matplotlib.pyplot as plt
-from scipy.signal import gaussian
 from scipy.signal import find_peaks
 from scipy.optimize import minimize
-from scipy.interpolate import interp1d
-from astropy.table import Table, Column
+from astropy.table import Table
 from lightkurve.lightcurve import LightCurve
 
 import model_utils
@@ -17,12 +18,82 @@ import spectral_utils
 
 __all__ = ['FlaresWithCOS']
 
+# wavelength regions [AA] free of strong emission features
+CONTINUUM_REGIONS = np.array([ [1067.506, 1070.062], [1074.662, 1076.533], [1078.881, 1082.167],
+                             [1087.828, 1090.035], [1103.787, 1107.862], [1110.500, 1112.946],
+                             [1113.618, 1117.377], [1119.548, 1121.622], [1125.255, 1126.923],
+                             [1140.873, 1145.141], [1146.285, 1151.544], [1152.602, 1155.579],
+                             [1159.276, 1163.222], [1164.565, 1173.959], [1178.669, 1188.363],
+                             [1195.162, 1196.864],
+                             #[1201.748, 1203.862], [1227.056, 1236.921],
+                             [1262.399, 1263.967], [1268.559, 1273.974], [1281.396, 1287.493],
+                             [1290.494, 1293.803], [1307.064, 1308.703], [1319.494, 1322.910],
+                             [1330.349, 1332.884], [1337.703, 1341.813], [1341.116, 1350.847] ])
+
+# Planck constants pre-converted so `blackbody` returns erg/s/cm^2/AA
+# for wavelengths in AA and temperatures in K
+_HC = (constants.h * constants.c).to(units.erg * units.AA).value
+_2HC2 = (2.0 * constants.h * constants.c**2).to(units.erg * units.AA**4 /
+                                                 units.s / units.cm**2).value
+_KB = constants.k_B.to(units.erg / units.K).value
+
+_EMPTY = np.zeros(0)
+
+
+@njit(cache=True, fastmath=True)
+def _gauss_conv(x, mu, std, f, lsf):
+    """
+    A gaussian model convolved with the line spread function. Matches
+    np.convolve(lsf, g, 'same'); pass an empty lsf to skip the convolution.
+    """
+    n = x.shape[0]
+    g = np.empty(n)
+    norm = f / (std * np.sqrt(np.pi * 2.0))
+    for i in range(n):
+        d = x[i] - mu
+        g[i] = norm * np.exp(-0.5 * d * d / std**2)
+
+    m = lsf.shape[0]
+    if m == 0:
+        return g
+
+    # 'same' mode keeps the central max(m, n) points of the full convolution
+    off = (min(m, n) - 1) // 2
+    out = np.zeros(max(m, n))
+    for k in range(out.shape[0]):
+        kk = k + off
+        s = 0.0
+        for j in range(max(0, kk - n + 1), min(m - 1, kk) + 1):
+            s += lsf[j] * g[kk - j]
+        out[k] = s
+    return out
+
+
+@njit(cache=True, fastmath=True)
+def _flare_trapz(Ff, Fq, t):
+    """
+    Trapezoidal integrals of (Ff - Fq) and (Ff - Fq)/Fq over t, computed
+    in a single pass. Returns the (energy, equivalent duration) integrals.
+    """
+    e = 0.0
+    d = 0.0
+    for i in range(1, Ff.shape[0]):
+        area = 0.5 * (t[i] - t[i-1]) * ((Ff[i] - Fq) + (Ff[i-1] - Fq))
+        e += area
+        d += area / Fq
+    return e, d
+
 class FlaresWithCOS(object):
     """
     A class to analyze flares as observed with Hubble/COS.
     """
+    # speed of light [km/s], as used by spectral_utils.to_velocity
+    _C_KMS = 3e5
+    # number of (mask, line) entries kept by the `model_line_shape` caches
+    _VEL_CACHE_SIZE = 32
+
     def __init__(self, wavelength, flux, flux_err, time,
-                 orbit, time_unit=units.s):
+                 orbit, time_unit=units.s, dtype=np.float32):
         """
         Initializes the class.
 
@@ -46,23 +117,80 @@ class FlaresWithCOS(object):
            in.
         time_unit : astropy.units.Unit
            The units of the time array. Default is seconds.
+        dtype : np.dtype, optional
+           The precision the spectra are stored in. Default is
+           np.float32, which halves the memory moved by the
+           band integrations; use np.float64 for full precision.
         """
 
-        self.wavelength = wavelength+0.0
-        self.flux = flux + 0.0
-        self.flux_err = flux_err+0.0
+        # wavelength, flux, and flux_err share one contiguous block
+        self._spec = np.empty((3,) + np.shape(wavelength), dtype=dtype)
+        self._spec[0] = wavelength
+        self._set_spec(1, 'flux', flux)
+        self._set_spec(2, 'flux_err', flux_err)
+
         self.time = time * time_unit
         self.orbit = orbit
+
         self.line_table = None
+        self._line_idx = {}
         self.lsf_table = None
+        self._lsf_wavelengths = None
+        self._lsf_matrix = None
         self.width_table = Table()
         self.error_table = Table()
         self.fuv130 = None
         self.continuum_mask = None
+        self._vel_cache = {}
+        self._peak_cache = {}
 
         self.flux_units =  units.erg / units.s / units.cm**2 / units.AA
 
 
+    def _set_spec(self, i, name, value):
+        """
+        Writes `value` into row `i` of the spectra block. The block has a
+        fixed shape, so arrays of any other shape are rejected rather than
+        broadcast.
+        """
+        if np.shape(value) != self._spec.shape[1:]:
+            raise ValueError('{} must have shape {}, got {}. Create a new '
+                             'FlaresWithCOS object to change the shape of '
+                             'the spectra.'.format(name, self._spec.shape[1:],
+                                                   np.shape(value)))
+        self._spec[i] = value
+
+    @property
+    def wavelength(self):
+        """ Array of wavelengths (a view into the spectra block). """
+        return self._spec[0]
+
+    @wavelength.setter
+    def wavelength(self, value):
+        self._set_spec(0, 'wavelength', value)
+        self._vel_cache = {}
+        self._peak_cache = {}
+
+    @property
+    def flux(self):
+        """ Array of flux spectra (a view into the spectra block). """
+        return self._spec[1]
+
+    @flux.setter
+    def flux(self, value):
+        self._set_spec(1, 'flux', value)
+        self._peak_cache = {}
+
+    @property
+    def flux_err(self):
+        """ Array of flux errors (a view into the spectra block). """
+        return self._spec[2]
+
+    @flux_err.setter
+    def flux_err(self, value):
+        self._set_spec(2, 'flux_err', value)
+
+
     def load_line_table(self, path, fname='line_table.txt',
                         format='csv', comment='#'):
         """
@@ -93,6 +221,10 @@ class FlaresWithCOS(object):
         self.line_table = Table.read(os.path.join(path, fname),
                                      format=format,
                                      comment=comment)
+        self._line_idx = {row['ion']: (row['wave_c'], row['vmin'], row['vmax'])
+                          for row in self.line_table}
+        self._vel_cache = {}
+        self._peak_cache = {}
 
 
     def to_velocity(self, wave, mid=None):
@@ -120,6 +252,17 @@ class FlaresWithCOS(object):
         return rv_km_s, mid
 
 
+    def _to_velocity_fast(self, wave, mid):
+        """
+        Unitless version of `to_velocity` for internal hot paths. Follows
+        spectral_utils.to_velocity (zero point snapped to the first
+        wavelength >= mid) and returns the velocity as floats in km/s.
+        """
+        mid = np.where(wave>=mid)[0][0]
+        lambda0 = wave[mid]
+        return (wave - lambda0) / lambda0 * self._C_KMS, mid
+
+
     def measure_ew(self, ion=None, line=None, vmin=None,
                    vmax=None, orbit='all', binsize=3):
         """
@@ -180,19 +323,23 @@ class FlaresWithCOS(object):
         ----------
         fuv130 : np.ndarray
            Array of flux values that constitute the FUV130 band.
-        """
-        fuv130 = np.zeros(len(self.time.value))
-        fuv130_err = np.zeros(len(self.time.value))
-
-        for i in range(len(self.wavelength)):
-            mask = np.where( ((self.wavelength[i] >= 1173.65) & (self.wavelength[i] <= 1197)) |
-                             ((self.wavelength[i] >= 1230) & (self.wavelength[i] <= 1274.04)) |
-                             ((self.wavelength[i] >= 1329.25) & (self.wavelength[i] <= 1355.49)) )[0]
 
+        Returns
+        -------
+        mask : np.ndarray
+           Boolean mask of shape `self.wavelength` marking the
+           wavelengths that fall within the FUV130 band.
+        """
+        w = self.wavelength
+        mask = ( ((w >= 1173.65) & (w <= 1197)) |
+                 ((w >= 1230) & (w <= 1274.04)) |
+                 ((w >= 1329.25) & (w <= 1355.49)) )
 
-            fuv130[i] = np.nansum(self.flux[i][mask])
+        fuv130 = np.nansum(np.where(mask, self.flux, 0.0), axis=1)
 
-            fuv130_err[i] = np.sqrt(np.nansum(self.flux_err[i][mask]**2) / len(mask))
+        counts = np.count_nonzero(mask, axis=1)
+        fuv130_err = np.sqrt(np.nansum(np.where(mask, self.flux_err**2, 0.0),
+                                       axis=1) / counts)
 
         self.fuv130 = fuv130 * self.flux_units * units.AA
         self.fuv130_err = fuv130_err * self.flux_units * units.AA
@@ -215,29 +362,34 @@ class FlaresWithCOS(object):
         d : float
            The distance to the star with astropy.units.Unit quantity.
         flux : np.array, optional
-           The flux array to measure the flare parameters. If None, this
+           The flux array to measure the flare parameters, in
+           erg/s/cm^2 if no units are attached. If None, this
            function uses the FUV130 flux.
 
         Returns
         -------
-        energy : float
-           The measured energy of the flare.
-        ed : float
-           The measured equivalent duration of the flare.
+        energy : astropy.units.Quantity
+           The measured energy of the flare in erg.
+        ed : astropy.units.Quantity
+           The measured equivalent duration of the flare in seconds.
         """
         if flux is None:
             if self.fuv130 is None:
-                self.measure_FUV130() * self.flux_units
-            flux = self.fuv130 + 0.0
-        if flux is not None:
-            flux = flux * self.flux_units / units.AA
+                self.measure_FUV130()
+            flux = self.fuv130
+
+        # strips units up front; band-integrated flux in erg/s/cm^2
+        if isinstance(flux, units.Quantity):
+            flux = flux.to(self.flux_units * units.AA).value
+        flux = np.asarray(flux, dtype=np.float64)
+        t = self.time[fmask].to(units.s).value
 
-        Fq = np.nanmedian(flux[qmask]/10**-13) #* units.erg / units.s / units.cm**2
-        Ff = (flux[fmask]/10**-13) #* units.erg / units.s / units.cm**2
+        Fq = float(np.nanmedian(flux[qmask]))
+        Ff = np.ascontiguousarray(flux[fmask])
 
-        eng = np.trapz(Ff-Fq, x=self.time[fmask]) * 4 * np.pi * d**2
-        dur = np.trapz((Ff-Fq)/Fq, x=self.time[fmask])
-        return eng, dur
+        eng, dur = _flare_trapz(Ff, Fq, t)
+        eng *= 4 * np.pi * d.to(units.cm).value**2
+        return eng * units.erg, dur * units.s
 
     def build_sed(self, d, mask=None):
         """
@@ -265,13 +417,11 @@ class FlaresWithCOS(object):
                 self.identify_continuum()
             mask = self.continuum_mask[0] == 0
 
-        sed = np.zeros(len(self.flux))
+        eng = np.trapz(self.flux[:, mask], x=self.wavelength[:, mask], axis=1)
 
-        for i in range(len(self.flux)):
-            eng = np.trapz(self.flux[i][mask]*self.flux_units,
-                           x=self.wavelength[i][mask]*units.AA) * 4 * np.pi * d**2
-            eng = eng.to(units.erg/units.s)
-            sed[i] = eng.value
+        # converts to erg/s once rather than per spectrum
+        conv = (self.flux_units * units.AA).to(units.erg / units.s / units.cm**2)
+        sed = eng * (conv * 4 * np.pi * d.to(units.cm).value**2)
 
         return sed
 
@@ -337,9 +487,9 @@ class FlaresWithCOS(object):
            length = `flux`.
         """
 
-        time = np.array(self.time[mask].value) + 0.0
-        flux = np.array(self.width_table[ion][mask]) + 0.0
-        flux_err = np.array(self.error_table[ion][mask]) /10.0 #+ 0.0
+        time = np.array(self.time[mask].value)
+        flux = np.asarray(self.width_table[ion].data)[mask]
+        flux_err = np.asarray(self.error_table[ion].data)[mask] /10.0
 
         #if x is not None and y is None:
         #    finterp = interp1d(time, flux)
@@ -366,43 +516,45 @@ class FlaresWithCOS(object):
         ##########
         if model.lower() == 'white light':
 
-            fmodel = Model(model_utils.flare_model,
-                           prefix='f{0:02d}_'.format(0))
-
-            if len(amp) > 1:
-                for i in range(1, len(amp)):
-                    fmodel += Model(model_utils.flare_model,
-                                    prefix='f{0:02d}_'.format(i))
+            fmodel = reduce(operator.add,
+                            [Model(model_utils.flare_model,
+                                   prefix='f{0:02d}_'.format(i))
+                             for i in range(len(amp))])
 
             pars = fmodel.make_params()
 
+            specs = []
             for i in range(len(amp)):
-                pars['f{0:02d}_{1}'.format(i, 'amp')].set(value=amp[i], min=flux.min(), max=amp[i]*20)
-                pars['f{0:02d}_{1}'.format(i, 't0')].set(value=t0[i], min=t0[i]-60, max=t0[i]+60)
-                pars['f{0:02d}_{1}'.format(i, 'rise')].set(value=rise[i], min=0.001, max=100)
-                pars['f{0:02d}_{1}'.format(i, 'decay')].set(value=decay[i], min=0.001, max=300)
-                pars['f{0:02d}_offset_g'.format(i)].set(value=0, min=-1, max=10)
-                pars['f{0:02d}_offset_e'.format(i)].set(value=0, min=-1, max=10)
+                p = 'f{0:02d}_'.format(i)
+                specs += [(p+'amp', amp[i], True, flux.min(), amp[i]*20),
+                          (p+'t0', t0[i], True, t0[i]-60, t0[i]+60),
+                          (p+'rise', rise[i], True, 0.001, 100),
+                          (p+'decay', decay[i], True, 0.001, 300),
+                          (p+'offset_g', 0, True, -1, 10),
+                          (p+'offset_e', 0, True, -1, 10)]
+            pars.add_many(*specs)
 
         ##########
         ### SKEWED GAUSSIAN MODEL ###
         ##########
         elif model.lower() == 'skewed gaussian':
 
-            fmodel = Model(model_utils.skewed_gaussian, prefix='f{0:02d}_'.format(0))
-
-            if len(eta) > 1:
-                for i in range(1, len(eta)):
-                    fmodel += Model(model_utils.skewed_gaussian, prefix='f{0:02d}_'.format(i))
+            fmodel = reduce(operator.add,
+                            [Model(model_utils.skewed_gaussian,
+                                   prefix='f{0:02d}_'.format(i))
+                             for i in range(len(eta))])
 
             pars = fmodel.make_params()
 
+            specs = []
             for i in range(len(eta)):
-                pars['f{0:02d}_{1}'.format(i, 'eta')].set(value=eta[i], min=eta[i]-100, max=eta[i]+100)
-                pars['f{0:02d}_{1}'.format(i, 'omega')].set(value=omega[i], min=0.1, max=500)
-                pars['f{0:02d}_{1}'.format(i, 'alpha')].set(value=alpha[i], min=0, max=200)
-                pars['f{0:02d}_{1}'.format(i, 'normalization')].set(value=1e-3, min=1e-7, max=1)
-                pars['f{0:02d}_{1}'.format(i, 'offset')].set(value=0, min=-1, max=10)
+                p = 'f{0:02d}_'.format(i)
+                specs += [(p+'eta', eta[i], True, eta[i]-100, eta[i]+100),
+                          (p+'omega', omega[i], True, 0.1, 500),
+                          (p+'alpha', alpha[i], True, 0, 200),
+                          (p+'normalization', 1e-3, True, 1e-7, 1),
+                          (p+'offset', 0, True, -1, 10)]
+            pars.add_many(*specs)
 
 
         ##########
@@ -410,29 +562,28 @@ class FlaresWithCOS(object):
         ##########
         elif model.lower() == 'convolved':
 
-            fmodel = Model(model_utils.convolved_model,
-                           prefix='f{0:02d}_'.format(0))
-
-            if len(eta) > 1:
-                for i in range(1, len(eta)):
-
-                    fmodel += Model(model_utils.convolved_model,
-                                    prefix='f{0:02d}_'.format(i))
+            fmodel = reduce(operator.add,
+                            [Model(model_utils.convolved_model,
+                                   prefix='f{0:02d}_'.format(i))
+                             for i in range(len(eta))])
 
             pars = fmodel.make_params()
 
+            specs = []
             for i in range(len(eta)):
-                pars['f{0:02d}_{1}'.format(i, 'eta')].set(value=eta[i], min=eta[i]-100, max=eta[i]+100)
-                pars['f{0:02d}_{1}'.format(i, 'omega')].set(value=omega[i], min=1, max=750)
-                pars['f{0:02d}_{1}'.format(i, 'alpha')].set(value=alpha[i], min=0, max=200)
-                pars['f{0:02d}_{1}'.format(i, 'normalization')].set(value=1, min=0.9, max=1.1)
+                p = 'f{0:02d}_'.format(i)
+                specs += [(p+'eta', eta[i], True, eta[i]-100, eta[i]+100),
+                          (p+'omega', omega[i], True, 1, 750),
+                          (p+'alpha', alpha[i], True, 0, 200),
+                          (p+'normalization', 1, True, 0.9, 1.1),
 
-                pars['f{0:02d}_{1}'.format(i, 'amp')].set(value=amp[i], min=flux.min(), max=amp[i]*20)
-                pars['f{0:02d}_{1}'.format(i, 't0')].set(value=t0[i], min=np.nanmin(time), max=np.nanmax(time))
-                pars['f{0:02d}_{1}'.format(i, 'rise')].set(value=rise[i], min=0.001, max=100)
-                pars['f{0:02d}_{1}'.format(i, 'decay')].set(value=decay[i], min=0.001, max=300)
+                          (p+'amp', amp[i], True, flux.min(), amp[i]*20),
+                          (p+'t0', t0[i], True, np.nanmin(time), np.nanmax(time)),
+                          (p+'rise', rise[i], True, 0.001, 100),
+                          (p+'decay', decay[i], True, 0.001, 300),
 
-                pars['f{0:02d}_{1}'.format(i, 'offset')].set(value=0, min=-1, max=10)
+                          (p+'offset', 0, True, -1, 10)]
+            pars.add_many(*specs)
 
 
         else:
@@ -466,17 +617,24 @@ class FlaresWithCOS(object):
            in steps of 5 Angstroms.
         """
 
-        lsf = Table.read(fname, format='ascii')
-
-        lsf_table = Table()
+        lsf = Table.read(fname, format='ascii').as_array()
 
-        for key in lsf.colnames:
-            name = lsf[key][0]
-            data = lsf[key][1:-1] # removes bad rows from the LSF
-            lsf_table.add_column(Column(data, name))
+        # first row holds the column names; removes bad rows from the LSF
+        names = [str(lsf[key][0]) for key in lsf.dtype.names]
+        lsf_table = Table([lsf[key][1:-1] for key in lsf.dtype.names],
+                          names=names, copy=False)
 
         self.lsf_table = lsf_table
 
+        # normalized profiles stacked by increasing center wavelength
+        waves = np.array([float(n) for n in lsf_table.colnames])
+        order = np.argsort(waves)
+        self._lsf_wavelengths = waves[order]
+        self._lsf_matrix = np.stack([np.asarray(lsf_table[lsf_table.colnames[i]],
+                                                dtype=np.float64)
+                                     for i in order])
+        self._lsf_matrix /= np.nanmax(self._lsf_matrix, axis=1)[:, None]
+
 
     def model_line_shape(self, ion, mask, shape='gaussian',
                          ext=100, ngauss=1, f=None, mus=None,
@@ -513,43 +671,63 @@ class FlaresWithCOS(object):
            (len(default_bounds)==4) or bounds for each parameter passed in
            (len(default_bounds)==4*ngauss). Default is [(-100,100), (1,100),
            (1,3000), (1,20)].
+
+        Returns
+        -------
+        vel, f, ferr : np.ndarray
+           The velocity grid, flux, and flux error of the fit region.
+        wave : np.ndarray
+           The wavelengths of the fit region for each masked spectrum.
+        lsf : np.ndarray
+           The line spread function interpolated onto `vel`.
+        good : np.ndarray
+           Boolean mask of the samples used in the fit. Pass `good=None`
+           to `out.eval_components` or `out.eval` to evaluate the model
+           on the full `vel` grid.
+        out : lmfit.model.ModelResult
+           The fit results.
            """
-        def gaussian(x, mu, std, f):#, off):
+        def gaussian(x, mu, std, f, good=None):#, off):
             nonlocal lsf
-            exp = -0.5 * (x-mu)**2 / std**2
-            denom = std * np.sqrt(np.pi * 2.0)
-            g = f / denom * np.exp(exp)
-            if lsf is not None:
-                return np.convolve(lsf, g, 'same')# + off
-            else:
-                return g
-
-        wc   = self.line_table[self.line_table['ion']==ion]['wave_c'][0]
-        vmin = self.line_table[self.line_table['ion']==ion]['vmin'][0]
-        vmax = self.line_table[self.line_table['ion']==ion]['vmax'][0]
-
-        velocity, _ = self.to_velocity(np.nanmedian(self.wavelength[mask],axis=0),wc)
-        velocity    = velocity.value + 0.0
-
-        reg = np.where( (velocity >= vmin-ext) & (velocity <= vmax+ext) )[0]
+            # evaluated on the full grid so the LSF convolution is unchanged;
+            # `good` selects the samples that enter the residuals
+            g = _gauss_conv(x, mu, std, f, lsf if lsf is not None else _EMPTY)
+            return g if good is None else g[good]
+
+        wc, vmin, vmax = self._line_idx[ion]
+
+        # the median template + velocity grid only depend on the mask and line
+        mask_arr = np.asarray(mask)
+        vkey = (mask_arr.dtype.str, mask_arr.shape, mask_arr.tobytes(),
+                round(float(wc), 6), vmin, vmax, ext)
+        if vkey not in self._vel_cache:
+            velocity, _ = self._to_velocity_fast(np.nanmedian(self.wavelength[mask],axis=0),wc)
+
+            reg = np.where( (velocity >= vmin-ext) & (velocity <= vmax+ext) )[0]
+            if len(self._vel_cache) >= self._VEL_CACHE_SIZE:
+                self._vel_cache.pop(next(iter(self._vel_cache)))
+            self._vel_cache[vkey] = (velocity, reg)
+        velocity, reg = self._vel_cache[vkey]
 
         wave = self.wavelength[mask][:,reg]
 
         # finds the line spread profile closest to the ion in question #
         if lsf is not None:
 
-            argmin = np.argmin(np.abs([float(i) for i in self.lsf_table.colnames] - wc))
-            lsf = self.lsf_table[self.lsf_table.colnames[argmin]].data
-            lsf /= np.nanmax(lsf)
+            lsf_waves = self._lsf_wavelengths
+            idx = min(np.searchsorted(lsf_waves, wc), len(lsf_waves)-1)
+            if idx > 0 and wc - lsf_waves[idx-1] <= lsf_waves[idx] - wc:
+                idx -= 1
+            lsf = self._lsf_matrix[idx]
 
             # interpolate line spread function to same length as line profile #
             ivel = np.linspace(velocity[reg][0],
                                velocity[reg][-1],
                                len(lsf))
-            lsf_interp = interp1d(ivel, lsf)
-            lsf = lsf_interp(velocity[reg]) + 0.0
+            lsf = np.interp(velocity[reg], ivel, lsf)
 
         # uses the mean flux across the mask as the data to fit to
+        template = f is None
         if f is None:
             f = np.nanmean(self.flux[mask,:], axis=0)
         f = f[reg] * scaling
@@ -559,7 +737,7 @@ class FlaresWithCOS(object):
             ferr = np.sqrt(np.nansum(self.flux_err[mask,:]**2,axis=0))/len(self.flux[mask,:])
         ferr = ferr[reg] * scaling
 
-        vel = velocity[reg] + 0.0
+        vel = velocity[reg]
 
         for i in range(ngauss):
             if i == 0:
@@ -574,16 +752,25 @@ class FlaresWithCOS(object):
                 mus = np.array([0, 30, -30, 100,-100, -150,
                                 150, -200, 200],dtype=np.float32)
             else:
-                fp,_ = find_peaks(f, width=15)
-                best = np.argsort(f[fp])[-ngauss:]
-                mus = vel[fp][best] + 0.0
-
-                if len(best) < ngauss:
-                    fp,_ = find_peaks(f, width=5)
+                # re-fits of the same masked template reuse the peaks found before
+                key = (ion, ngauss, scaling) + vkey if template else None
+                if key not in self._peak_cache:
+                    fp,_ = find_peaks(f, width=15)
                     best = np.argsort(f[fp])[-ngauss:]
-                    mus = vel[fp][best] + 0.0
-                if len(best) < ngauss:
-                    mus=np.zeros(ngauss)
+                    mus = vel[fp][best]
+
+                    if len(best) < ngauss:
+                        fp,_ = find_peaks(f, width=5)
+                        best = np.argsort(f[fp])[-ngauss:]
+                        mus = vel[fp][best]
+                    if len(best) < ngauss:
+                        mus=np.zeros(ngauss)
+                    if key is not None:
+                        if len(self._peak_cache) >= self._VEL_CACHE_SIZE:
+                            self._peak_cache.pop(next(iter(self._peak_cache)))
+                        self._peak_cache[key] = mus
+                else:
+                    mus = self._peak_cache[key]
 
         for i in range(ngauss):
             pars['g{}_{}'.format(i, 'mu')].set(value=mus[i], min=vel.min()+40,
@@ -593,13 +780,17 @@ class FlaresWithCOS(object):
 
         init = gmodel.eval(pars, x=vel)
 
-        out = gmodel.fit(f,
+        # drops masked/NaN samples from the residuals
+        good = np.isfinite(f) & np.isfinite(ferr) & (ferr > 0)
+
+        out = gmodel.fit(f[good],
                          pars,
                          x=vel,
-                         weights=1.0/ferr,
+                         good=good,
+                         weights=1.0/ferr[good],
                          verbose=True,
                          max_nfev=3000)
-        return vel, f, ferr, wave, lsf, out
+        return vel, f, ferr, wave, lsf, good, out
 
 
     def new_lines(self, template, distance=150, prominence=None):
@@ -641,25 +832,13 @@ class FlaresWithCOS(object):
            A binary mask for the template that corresponds to the continuum
            isolated regions.
         """
-        cont = np.array([ [1067.506, 1070.062], [1074.662, 1076.533], [1078.881, 1082.167],
-                          [1087.828, 1090.035], [1103.787, 1107.862], [1110.500, 1112.946],
-                          [1113.618, 1117.377], [1119.548, 1121.622], [1125.255, 1126.923],
-                          [1140.873, 1145.141], [1146.285, 1151.544], [1152.602, 1155.579],
-                          [1159.276, 1163.222], [1164.565, 1173.959], [1178.669, 1188.363],
-                          [1195.162, 1196.864],
-                          #[1201.748, 1203.862], [1227.056, 1236.921],
-                          [1262.399, 1263.967], [1268.559, 1273.974], [1281.396, 1287.493],
-                          [1290.494, 1293.803], [1307.064, 1308.703], [1319.494, 1322.910],
-                          [1330.349, 1332.884], [1337.703, 1341.813], [1341.116, 1350.847] ])
-        cont_inds = np.ones(self.wavelength.shape, dtype=int)
-
-        for i in range(len(self.wavelength)):
-            for c in cont:
-                inds = np.where((self.wavelength[i] >= c[0]) &
-                                (self.wavelength[i] <= c[1]) )[0]
-                cont_inds[i][inds] = 0
-
-        self.continuum_mask = cont_inds
+        w = self.wavelength
+        inside = np.zeros(w.shape, dtype=bool)
+
+        for lo, hi in CONTINUUM_REGIONS:
+            inside |= (w >= lo) & (w <= hi)
+
+        self.continuum_mask = (~inside).astype(np.int8)
 
 
     def blackbody(self, x, T, scaling):
@@ -669,9 +848,9 @@ class FlaresWithCOS(object):
         Parameters
         ----------
         x : np.ndarray
-           Wavelength array.
+           Wavelength array in Angstroms.
         T : float
-           Temperature of the blackbody.
+           Temperature of the blackbody in Kelvin.
         scaling : float
            Scaling the flux to the blackbody.
 
@@ -680,10 +859,6 @@ class FlaresWithCOS(object):
         bb : np.ndarray
            Log(Blackbody function).
         """
-        T *= units.K
-        x *= units.AA
-        frac = 2.0 * constants.h * constants.c**2 / x**5
-        exp = (constants.h * constants.c) / (x * constants.k_B * T)
-        func =  frac * 1.0/(np.exp(exp) - 1.0)
-        func = func.to(self.flux_units)
-        return np.log10(func.value)*scaling
+        exp = _HC / (x * _KB * T)
+        func = _2HC2 / x**5 * 1.0/(np.exp(exp) - 1.0)
+        return np.log10(func)*scaling
@@ -1,27 +1,71 @@
+import sys
+import functools
 import numpy as np
-from pylab import cm
 import matplotlib
-import matplotlib.pyplot as plt
+
+# defaults to the non-interactive Agg backend only when no backend has been
+# chosen yet (via MPLBACKEND, matplotlib.use, or by importing pyplot);
+# set MPLBACKEND (e.g. MPLBACKEND=qt5agg) before importing for interactive use
+if ('matplotlib.pyplot' not in sys.modules and
+    matplotlib.rcParams._get_backend_or_none() is None):
+    matplotlib.use('Agg')
+
+# pyplot is imported inside the functions that draw figures so importing
+# this module stays cheap
+from matplotlib.lines import Line2D
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection, PolyCollection
 
 __all__ = ['load_inferno', 'make_onerow']
 
+@functools.lru_cache(maxsize=32)
 def load_inferno(n=10, colormap='inferno'):
     """ Returns a discrete colormap with n values.
+    The result is cached per (n, colormap) and returned read-only.
     """
-    cmap = cm.get_cmap(colormap, n)
-    colors = []
-    for i in range(cmap.N):
-        rgb = cmap(i)[:3]
-        colors.append(matplotlib.colors.rgb2hex(rgb))
-    colors = np.array(colors)[1:-1]
+    cmap = matplotlib.colormaps[colormap].resampled(n)
+    rgb = (cmap(np.arange(cmap.N))[:, :3] * 255).round().astype(np.uint8)
+    colors = np.array(['#%02x%02x%02x' % tuple(row) for row in rgb])[1:-1]
+    colors.flags.writeable = False
     return colors
 
+def _subplots(figsize=None, **kwargs):
+    """
+    Creates a figure and its axes. With the headless Agg backend the
+    figure is built directly on an Agg canvas, so it is never registered
+    with (or kept alive by) pyplot; otherwise plt.subplots is used so
+    interactive and inline backends still display the figure.
+    """
+    if matplotlib.get_backend().lower() == 'agg':
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        return fig, fig.subplots(**kwargs)
+
+    import matplotlib.pyplot as plt
+    return plt.subplots(figsize=figsize, **kwargs)
+
+def _add_break_marks(ax, d, left=False, right=False):
+    """
+    Draws the diagonal broken-axis marks on the left and/or right
+    edges of an axis as a single collection.
+    """
+    segs = []
+    if right:
+        segs += [[(1-d,-d), (1+d,+d)], [(1-d,1-d), (1+d,1+d)]]
+    if left:
+        segs += [[(-d,1-d), (+d,1+d)], [(-d,-d), (+d,+d)]]
+    ax.add_collection(LineCollection(segs, transform=ax.transAxes, colors='k',
+                                     linewidths=matplotlib.rcParams['lines.linewidth'],
+                                     clip_on=False),
+                      autolim=False)
+
 def make_onerow():
     """
     Creates a broken axis plot for one visit.
     """
-    fig, axes = plt.subplots(ncols=5, nrows=1,
-                             figsize=(20,5))
+    fig, axes = _subplots(ncols=5, nrows=1,
+                          figsize=(20,5))
 
     ax = axes.reshape(-1)
 
@@ -32,27 +76,16 @@ def make_onerow():
             ax[j].spines['right'].set_visible(False)
             ax[j].spines['left'].set_visible(False)
             ax[j].set_yticks([])
-
-
-            kwargs = dict(transform=ax[j].transAxes, color='k', clip_on=False)
-            ax[j].plot((1-d,1+d), (-d,+d), **kwargs)
-            ax[j].plot((1-d,1+d),(1-d,1+d), **kwargs)
-            kwargs.update(transform=ax[j].transAxes)  # switch to the bottom axes
-            ax[j].plot((-d,+d), (1-d,1+d), **kwargs)
-            ax[j].plot((-d,+d), (-d,+d), **kwargs)
+            _add_break_marks(ax[j], d, left=True, right=True)
 
         elif j == 0:
             ax[j].spines['right'].set_visible(False)
-            kwargs = dict(transform=ax[j].transAxes, color='k', clip_on=False)
-            ax[j].plot((1-d,1+d), (-d,+d), **kwargs)
-            ax[j].plot((1-d,1+d),(1-d,1+d), **kwargs)
+            _add_break_marks(ax[j], d, right=True)
 
         else:
             ax[j].spines['left'].set_visible(False)
             ax[j].set_yticks([])
-            kwargs.update(transform=ax[j].transAxes)  # switch to the bottom axes
-            ax[j].plot((-d,+d), (1-d,1+d), **kwargs)
-            ax[j].plot((-d,+d), (-d,+d), **kwargs)
+            _add_break_marks(ax[j], d, left=True)
 
         ax[j].set_rasterized(True)
 
@@ -63,8 +96,8 @@ def make_tworow():
     """
     Creates a broken axis plot for one visit.
     """
-    fig, axes = plt.subplots(ncols=5, nrows=2,
-                             figsize=(20,10))
+    fig, axes = _subplots(ncols=5, nrows=2,
+                          figsize=(20,10))
 
     ax = axes.reshape(-1)
 
@@ -76,51 +109,87 @@ def make_tworow():
             ax[j].spines['right'].set_visible(False)
             ax[j].spines['left'].set_visible(False)
             ax[j].set_yticks([])
-
-
-            kwargs = dict(transform=ax[j].transAxes, color='k', clip_on=False)
-            ax[j].plot((1-d,1+d), (-d,+d), **kwargs)
-            ax[j].plot((1-d,1+d),(1-d,1+d), **kwargs)
-            kwargs.update(transform=ax[j].transAxes)
-
-            ax[j].plot((-d,+d), (1-d,1+d), **kwargs)
-            ax[j].plot((-d,+d), (-d,+d), **kwargs)
+            _add_break_marks(ax[j], d, left=True, right=True)
 
         elif j == 0 or j == 5:
             ax[j].spines['right'].set_visible(False)
-            kwargs = dict(transform=ax[j].transAxes, color='k', clip_on=False)
-            ax[j].plot((1-d,1+d), (-d,+d), **kwargs)
-            ax[j].plot((1-d,1+d),(1-d,1+d), **kwargs)
+            _add_break_marks(ax[j], d, right=True)
 
         else:
             ax[j].spines['left'].set_visible(False)
             ax[j].set_yticks([])
-            kwargs.update(transform=ax[j].transAxes)
-
-            ax[j].plot((-d,+d), (1-d,1+d), **kwargs)
-            ax[j].plot((-d,+d), (-d,+d), **kwargs)
+            _add_break_marks(ax[j], d, left=True)
 
         ax[j].set_rasterized(True)
 
     return fig, ax
 
+def _band_polygons(x, lo, hi):
+    """
+    Returns the polygons filling between lo and hi, split wherever
+    any of the inputs are not finite (as fill_between does).
+    """
+    good = np.isfinite(x) & np.isfinite(lo) & np.isfinite(hi)
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], good.astype(np.int8), [0]))))
+    polys = []
+    for start, stop in zip(edges[::2], edges[1::2]):
+        xs = x[start:stop]
+        polys.append(np.concatenate([np.column_stack([xs, lo[start:stop]]),
+                                     np.column_stack([xs[::-1], hi[start:stop][::-1]])]))
+    return polys
+
+def _binned_stats(idx, y, nbins, width=None):
+    """ Returns the mean and std of y in each bin of idx.
+    If every bin holds `width` consecutive points, y is reduced as a
+    (nbins, width) block instead.
+    """
+    if width is not None:
+        block = y.reshape(nbins, width)
+        return np.mean(block, axis=1), np.std(block, axis=1)
+
+    cnt = np.bincount(idx, minlength=nbins)
+    s1 = np.bincount(idx, weights=y, minlength=nbins)
+    s2 = np.bincount(idx, weights=y*y, minlength=nbins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = s1 / cnt
+        std = np.sqrt(np.maximum(s2 / cnt - mean**2, 0.0))
+    return mean, std
+
 def plot_binned_resid(x, yin, yoot, velbins, ebar_dict, ax1, ax2, factor,
                       color='k', markerfacecolor='w'):
     """
     Plots the binned residuals.
     """
-    for i in range(len(velbins)-1):
-        inds = ( (x >= velbins[i]) & (x < velbins[i+1]))
-
-        ax1.errorbar((velbins[i]+velbins[i+1])/2.0,
-                    np.nanmean(yin[inds] - yoot[inds])*factor,
-                    yerr=np.nanstd(yin[inds] - yoot[inds])*factor, color=color,
-                    markerfacecolor=markerfacecolor, **ebar_dict)
-
-        ax2.errorbar((velbins[i]+velbins[i+1])/2.0,
-                    np.nanmean(yin[inds] / yoot[inds]),
-                    yerr=np.nanstd(yin[inds] / yoot[inds]), color=color,
-                    markerfacecolor=markerfacecolor, **ebar_dict)
+    x = np.asarray(x)
+    yin = np.asarray(yin)
+    yoot = np.asarray(yoot)
+    nbins = len(velbins) - 1
+
+    # assigns every point to its [velbins[i], velbins[i+1]) bin in one pass,
+    # dropping NaNs once so the per-bin reductions need no nan handling
+    idx = np.digitize(x, velbins) - 1
+    keep = (idx >= 0) & (idx < nbins) & np.isfinite(yin) & np.isfinite(yoot)
+    idx = idx[keep]
+    yin, yoot = yin[keep], yoot[keep]
+
+    # sorted points split evenly across bins reduce as one 2D block
+    cnt = np.bincount(idx, minlength=nbins)
+    width = None
+    if cnt[0] > 0 and np.all(cnt == cnt[0]) and np.all(np.diff(idx) >= 0):
+        width = cnt[0]
+
+    centers = (velbins[:-1] + velbins[1:])/2.0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        diff_mean, diff_std = _binned_stats(idx, yin - yoot, nbins, width)
+        ratio_mean, ratio_std = _binned_stats(idx, yin / yoot, nbins, width)
+
+    ax1.errorbar(centers, diff_mean*factor, yerr=diff_std*factor,
+                 color=color, markerfacecolor=markerfacecolor,
+                 linestyle='none', **ebar_dict)
+
+    ax2.errorbar(centers, ratio_mean, yerr=ratio_std,
+                 color=color, markerfacecolor=markerfacecolor,
+                 linestyle='none', **ebar_dict)
     return
 
 def plot_combined_lines(table, lines, visit=1, factor=1e14, binned_resid=False,
@@ -139,22 +208,24 @@ def plot_combined_lines(table, lines, visit=1, factor=1e14, binned_resid=False,
        List of which lines were used in the analysis. This will be used as the
        subplot titles as well.
     """
-    if type(visit) == list or type(visit) == np.ndarray:
-        pass
-    else:
-        visit = [visit]
+    visit = np.atleast_1d(visit)
 
 #    if len(lines)==1:
 #        ncols=1
     #else:
     ncols=len(lines)+1
 
-    fig, axes = plt.subplots(nrows=3, ncols=ncols, figsize=(24,10),
-                             sharex=True)
+    fig, axes = _subplots(nrows=3, ncols=ncols, figsize=(24,10),
+                          sharex=True)
 
-    axes = axes.reshape(-1)
+    top, mid, bot = axes
     fig.set_facecolor('w')
 
+    # the per-line ratio panels are dimensionless and share one y-axis;
+    # flux and difference panels keep their own scale per line
+    for ax in bot[1:-1]:
+        ax.sharey(bot[0])
+
     color = ['k', 'r']
     color  = [['#590d22', '#003366', '#668151'],
               ['#ff758f', '#66b2ff', '#a0db72']]
@@ -165,114 +236,122 @@ def plot_combined_lines(table, lines, visit=1, factor=1e14, binned_resid=False,
 
     ebar_dict = {'marker':'o', 'zorder':10,
                  'ms':6, 'lw':1.5, 'markeredgewidth':1.5}
-    x = (table['velocity'][1:] + table['velocity'][:-1])/2.0
-
-    # dealing with table related things
-    table = table[:-1]
-    fcolname = 'line{0:02d}_{1}_flux_visit{2}'
-    ecolname = 'line{0:02d}_{1}_error_visit{2}'
-    it_colname = 'line{0:02d}_it_flux_visit{1}'
-    oot_colname = 'line{0:02d}_oot_flux_visit{1}'
+    velocity = np.asarray(table['velocity'])
+    x = (velocity[1:] + velocity[:-1])/2.0
+
+    # resolves every column name once; kind is 'it' or 'oot'
+    names = {(i,j,k): (f'line{i:02d}_{key[j]}_flux_visit{visit[k]}',
+                       f'line{i:02d}_{key[j]}_error_visit{visit[k]}')
+             for k in range(len(visit))
+             for i in range(len(lines))
+             for j in range(2)}
+
+    # pulls every column out of the table once as a plain array; the last
+    # row is dropped with a view to match the length of x
+    flux = {ijk: np.asarray(table[fname])[:-1] for ijk, (fname, _) in names.items()}
+    err = {ijk: np.asarray(table[ename])[:-1] for ijk, (_, ename) in names.items()}
+    # the in/out-of transit columns are the 'it'/'oot' flux columns
+    it = {(i,k): flux[(i,0,k)] for i in range(len(lines)) for k in range(len(visit))}
+    oot = {(i,k): flux[(i,1,k)] for i in range(len(lines)) for k in range(len(visit))}
+    diffs = {ik: (it[ik] - oot[ik])*factor for ik in it}
+    ratios = {ik: it[ik] / oot[ik] for ik in it}
 
     offset = 0
 
+    # line profiles and error bands are drawn as one collection per axis
+    segs = [[] for i in range(len(lines))]
+    seg_colors = [[] for i in range(len(lines))]
+    bands = [[] for i in range(len(lines))]
+    band_colors = [[] for i in range(len(lines))]
+    handles = []
+
     for k in range(len(visit)):
+        vk = int(visit[k])
+        label = 'Visit {}'.format(visit[k]+1)
+        handles.append(Line2D([], [], color=color[1][vk], lw=4, label=label))
 
         for i in range(len(lines)):
-            axes[i].set_title(lines[i])
+            top[i].set_title(lines[i])
 
             for j in range(2):
 
-                y = table[fcolname.format(i, key[j], visit[k])]*factor
-                yerr = table[ecolname.format(i, key[j], visit[k])]*factor
-
-                if j == 1:
-                    label='Visit {}'.format(visit[k]+1)
-                else:
-                    label = ''
+                y = flux[(i,j,k)]*factor
+                yerr = err[(i,j,k)]*factor
 
-                axes[i].plot(x, y+offset, color=color[j][int(visit[k])],
-                             label=label)
+                segs[i].append(np.column_stack([x, y+offset]))
+                seg_colors[i].append(color[j][vk])
 
-                axes[i].fill_between(x, y-yerr+offset, y+yerr+offset,
-                                     color=color[j][int(visit[k])], alpha=0.4,
-                                     lw=0)
+                polys = _band_polygons(x, y-yerr+offset, y+yerr+offset)
+                bands[i] += polys
+                band_colors[i] += [color[j][vk]] * len(polys)
 
             if binned_resid:
-                plot_binned_resid(x,
-                                  table[it_colname.format(i, visit[k])],
-                                  table[oot_colname.format(i, visit[k])],
-                                  velbins, ebar_dict, axes[i+len(lines)+1],
-                                  axes[i+(len(lines)+1)*2], factor,
-                                  color[0][int(visit[k])],
-                                  color[1][int(visit[k])])
+                plot_binned_resid(x, it[(i,k)], oot[(i,k)],
+                                  velbins, ebar_dict, mid[i], bot[i], factor,
+                                  color[0][vk],
+                                  color[1][vk])
                 alpha = 0.5
             else:
                 alpha = 1.0
 
 
-            axes[i+len(lines)+1].plot(x,
-                                      (table[it_colname.format(i, visit[k])] -
-                                        table[oot_colname.format(i, visit[k])])*factor,
-                                    color=color[1][int(visit[k])], alpha=alpha)
+            mid[i].plot(x, diffs[(i,k)],
+                        color=color[1][vk], alpha=alpha)
 
 
-            axes[i+len(lines)*2+2].plot(x,
-                                       (table[it_colname.format(i, visit[k])] /
-                                         table[oot_colname.format(i, visit[k])]),
-                                      color=color[1][int(visit[k])], alpha=alpha)
-
-            if i == 0 and k == 0:
-                summed_it = table[it_colname.format(i, visit[k])]
-                summed_oot = table[oot_colname.format(i, visit[k])]
-            else:
-                summed_it += table[it_colname.format(i, visit[k])]
-                summed_oot += table[oot_colname.format(i, visit[k])]
+            bot[i].plot(x, ratios[(i,k)],
+                        color=color[1][vk], alpha=alpha)
 
         offset += 0.6
 
-    axes[len(lines)].plot(x, summed_it*factor, c='k', label='Transit')
-    axes[len(lines)].plot(x, summed_oot*factor, c='r', label='Non-transit')
-    axes[len(lines)].legend(fontsize=14)
+    summed_it = np.stack(list(it.values())).sum(axis=0)
+    summed_oot = np.stack(list(oot.values())).sum(axis=0)
 
+    for i in range(len(lines)):
+        top[i].add_collection(PolyCollection(bands[i], facecolors=band_colors[i],
+                                              alpha=0.4, lw=0))
+        top[i].add_collection(LineCollection(segs[i], colors=seg_colors[i]))
+        top[i].autoscale_view()
 
-    axes[len(lines)*2+1].plot(x,
-                              (summed_it - summed_oot)*factor,
-                              'k', alpha=alpha)
-    axes[len(lines)*3+2].plot(x, summed_it / summed_oot, 'k',
-                              alpha=alpha)
+    top[-1].plot(x, summed_it*factor, c='k', label='Transit')
+    top[-1].plot(x, summed_oot*factor, c='r', label='Non-transit')
+    top[-1].legend(fontsize=14)
+
+
+    mid[-1].plot(x,
+                 (summed_it - summed_oot)*factor,
+                 'k', alpha=alpha)
+    bot[-1].plot(x, summed_it / summed_oot, 'k',
+                 alpha=alpha)
 
     ebar_dict['ms'] = 8
     if binned_resid:
         plot_binned_resid(x,
                           summed_it,
                           summed_oot,
-                          velbins, ebar_dict, axes[len(lines)*2+1],
-                          axes[len(lines)*3+2], factor)
+                          velbins, ebar_dict, mid[-1], bot[-1], factor)
+
 
+    top[-1].set_title('Combined')
 
-    axes[len(lines)].set_title('Combined')
+    top[0].set_ylabel('Flux Density\n[10$^{-14}$ erg s$^{-1}$ cm$^{-1} \AA^{-1}$]')
+    mid[0].set_ylabel('Difference\n(In - Out)')
+    bot[0].set_ylabel('Ratio\n(In/Out)')
 
-    axes[0].set_ylabel('Flux Density\n[10$^{-14}$ erg s$^{-1}$ cm$^{-1} \AA^{-1}$]')
-    axes[len(lines)+1].set_ylabel('Difference\n(In - Out)')
-    axes[(len(lines)+1)*2].set_ylabel('Ratio\n(In/Out)')
+    top[0].legend(handles, [h.get_label() for h in handles])
 
-    leg = axes[0].legend()
-    for legobj in leg.legendHandles:
-        legobj.set_linewidth(4.0)
+    div_max = float(np.nanmax(np.abs(ratios[(0,len(visit)-1)])))
+    ratio_max = float(np.nanmax(np.abs(summed_it/summed_oot)))
 
-    for i in np.arange((len(lines)+1),(len(lines)+1)*2,1):
-        print(i)
-        axes[i].axhline(0, color='darkorange')
-        axes[i+len(lines)+1].axhline(1, color='darkorange')
-        div = table[it_colname.format(0, visit[k])]/table[oot_colname.format(0, visit[k])]
-        if np.nanmax(np.abs(div)) > 3 and i < (len(lines)+len(lines)+1):
-            axes[i+len(lines)+1].set_ylim(-0.5,3)
+    for i in range(ncols):
+        mid[i].axhline(0, color='darkorange')
+        bot[i].axhline(1, color='darkorange')
+        if div_max > 3 and i < len(lines):
+            bot[i].set_ylim(-0.5,3)
 
-        if np.nanmax(np.abs(summed_it/summed_oot)) > 3:
-            print('bad')
-            axes[-1].set_ylim(-1,3)
+    if ratio_max > 3:
+        bot[-1].set_ylim(-1,3)
 
-    axes[-2].set_xlabel(r'Velocity [km s$^{-1}$]')
-    axes[-1].set_xlabel(r'Velocity [km s$^{-1}$]')
+    bot[-2].set_xlabel(r'Velocity [km s$^{-1}$]')
+    bot[-1].set_xlabel(r'Velocity [km s$^{-1}$]')
     return fig
@@ -39,6 +39,17 @@ def to_velocity(wave, mid):
     return rv_km_s, mid
 
 
+def _velocity_bounds(wave, line, vmin, vmax):
+    """
+    Returns the slice indices of a monotonic wavelength array that fall
+    within [vmin, vmax] (km/s) of the line center.
+    """
+    v, _ = to_velocity(wave, mid=line)
+    v = v.value
+    return (np.searchsorted(v, vmin, side='left'),
+            np.searchsorted(v, vmax, side='right'))
+
+
 def measure_ew(time, wavelength, flux, flux_err, line_table,
                ion=None, line=None, vmin=None, vmax=None,
                orbit_num='all', binsize=3, width_table=None, error_table=None):
@@ -86,22 +97,28 @@ def measure_ew(time, wavelength, flux, flux_err, line_table,
         error_table = Table()
 
     if ion is not None and line_table is not None:
-        line = line_table[line_table['ion']==ion]['wave_c']+0.0
-        vmin = line_table[line_table['ion']==ion]['vmin']+0.0
-        vmax = line_table[line_table['ion']==ion]['vmax']+0.0
+        line = line_table[line_table['ion']==ion]['wave_c'][0]+0.0
+        vmin = line_table[line_table['ion']==ion]['vmin'][0]+0.0
+        vmax = line_table[line_table['ion']==ion]['vmax'][0]+0.0
     elif ion is not None and line_table is None:
         return('No table found. Please load the line table first with \
                 load_line_table().')
 
-    widths = np.zeros(len(time))
-    errors = np.zeros(len(time))
+    # all spectra on one grid: find the line edges once and slice every row
+    if np.all(wavelength == wavelength[0]):
+        i0, i1 = _velocity_bounds(wavelength[0], line, vmin, vmax)
+        widths = np.nansum(flux[:, i0:i1], axis=1)
+        errors = np.sqrt(np.nansum(flux_err[:, i0:i1]**2, axis=1))
+
+    else:
+        widths = np.zeros(len(time))
+        errors = np.zeros(len(time))
 
-    for i in range(len(time)):
-        v, _ = to_velocity(wavelength[i], mid=line)
-        reg = np.where( (v.value >= vmin) & (v.value <= vmax) )[0]
+        for i in range(len(time)):
+            i0, i1 = _velocity_bounds(wavelength[i], line, vmin, vmax)
 
-        widths[i] = np.nansum(flux[i][reg])
-        errors[i] = np.sqrt(np.nansum(flux_err[i][reg]**2))
+            widths[i] = np.nansum(flux[i][i0:i1])
+            errors[i] = np.sqrt(np.nansum(flux_err[i][i0:i1]**2))
 
     try:
         if ion is not None: